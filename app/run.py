@@ -1,4 +1,5 @@
 import json
+import joblib
 import plotly
 import pandas as pd
 
@@ -8,7 +9,6 @@ from nltk.tokenize import word_tokenize
 from flask import Flask
 from flask import render_template, request, jsonify
 from plotly.graph_objs import Bar
-from sklearn.externals import joblib
 from sklearn.base import BaseEstimator, TransformerMixin
 from sqlalchemy import create_engine
 
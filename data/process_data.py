@@ -1,6 +1,7 @@
 import sys
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 
 def load_data(messages_filepath, categories_filepath):
     """
@@ -15,9 +16,14 @@ def load_data(messages_filepath, categories_filepath):
     df      dataframe merging categories and messages
     
     """    
-    messages = pd.read_csv(messages_filepath)
-    categories = pd.read_csv(categories_filepath)
-    df = messages.merge(categories, how='inner', on='id')
+    messages = pd.read_csv(messages_filepath, engine='c',
+                           usecols=['id', 'message', 'original', 'genre'],
+                           dtype={'id': np.int32, 'message': 'string',
+                                  'original': 'string', 'genre': 'category'})
+    categories = pd.read_csv(categories_filepath, engine='c',
+                             usecols=['id', 'categories'],
+                             dtype={'id': np.int32, 'categories': 'string'})
+    df = messages.merge(categories, how='inner', on='id', sort=False)
     
     return df
 
@@ -45,15 +51,12 @@ def clean_data(df):
     # rename the columns of `categories`
     categories.columns = category_colnames
     
-    # Convert category values to numeric
-    for column in categories:
-    # set each value to be the last character of the string
-        categories[column] = categories[column].astype(str).str[-1:]
-    # convert column from string to numeric
-        categories[column] = pd.to_numeric(categories[column])
+    # Convert category values to numeric: keep the last character of every
+    # value in a single pass over the stacked frame instead of column by column
+    categories = categories.stack().str[-1].astype(np.uint8).unstack()
 
-    # set binary: remove any records with values other than 0 or 1
-    categories[((categories==1)|(categories==0)).all(1)]
+    # set binary: mark the records with values other than 0 or 1
+    is_binary = categories.isin([0, 1]).all(axis=1).to_numpy()
     
     '''    
     # alternative convertion: convert values other greater than 1 to 1
@@ -64,15 +67,15 @@ def clean_data(df):
         categories[column] = pd.to_numeric(categories[column])
     '''
     
-    # concatenate the original dataframe with the new `categories` dataframe
-    df=df.drop('categories',axis=1)
-    df = pd.concat([df, categories], axis=1)
+    # replace the original categories column with the new `categories` columns
+    df = df.drop(columns='categories')
+    df[categories.columns] = categories
     
     # drop non-binary records
-    df.drop(df[df['age'] < 30.0].index, inplace=True)
+    df = df.loc[is_binary]
     
     # drop duplicates
-    df=df.drop_duplicates()
+    df = df.drop_duplicates(ignore_index=True)
     
     return df
     
@@ -90,7 +93,12 @@ def save_data(df, database_filename):
     """
     
     engine = create_engine("sqlite:///"+ database_filename)
-    df.to_sql('messages', engine, index=False, if_exists='replace')  
+    # write everything in one transaction and skip the fsyncs, the database
+    # can be rebuilt from the csv files if the write is interrupted
+    with engine.begin() as conn:
+        conn.execute(text('PRAGMA synchronous=OFF'))
+        conn.execute(text('PRAGMA journal_mode=MEMORY'))
+        df.to_sql('messages', conn, index=False, if_exists='replace', chunksize=5000)
 
 
 def main():
@@ -1,46 +1,83 @@
 import sys
 import nltk
-nltk.download(['punkt', 'wordnet','averaged_perceptron_tagger'])
+
+# only download the nltk data that isn't installed yet, this module is also
+# re-imported by every search worker; nltk 3.9+ loads the *_tab / *_eng
+# resources, older versions the original ones
+for package, path in [('punkt', 'tokenizers/punkt'),
+                      ('punkt_tab', 'tokenizers/punkt_tab'),
+                      ('wordnet', 'corpora/wordnet'),
+                      ('averaged_perceptron_tagger', 'taggers/averaged_perceptron_tagger'),
+                      ('averaged_perceptron_tagger_eng', 'taggers/averaged_perceptron_tagger_eng')]:
+    try:
+        nltk.data.find(path)
+    except LookupError:
+        nltk.download(package, quiet=True)
 
 # import libraries
 import re
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 from nltk.tokenize import word_tokenize
 from nltk.stem import WordNetLemmatizer
+from nltk.tag import PerceptronTagger
 
 from sklearn.pipeline import Pipeline, FeatureUnion
+from sklearn.compose import ColumnTransformer
 from sklearn.metrics import classification_report, confusion_matrix, accuracy_score
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.feature_selection import VarianceThreshold
 
 from sklearn.multioutput import MultiOutputClassifier
+
 from sklearn.linear_model import LogisticRegression
 from sklearn.tree import DecisionTreeClassifier
 
+from scipy import sparse
+from scipy.stats import randint
 from sqlalchemy import create_engine
+import joblib
 import pickle
 
+_URL_RE = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+_LEMMATIZER = WordNetLemmatizer()
+# nltk.pos_tag loads a new tagger model on every call, so load it once here
+_TAGGER = PerceptronTagger()
+# the corpus has ~34k distinct tokens, 2**16 buckets keep most of them apart;
+# the columns no token hashes to are dropped before the forests (see build_model)
+_N_FEATURES = 2 ** 16
+
+
+def starting_verb(text):
+    """
+    starting_verb
+    Check whether any sentence of a text starts with a verb
+    
+    Input:
+    text      text to be checked
+    
+    Returns:
+    True if a sentence starts with a verb (or a retweet), False otherwise
+    """
+    return _analyze(text)[1]
+
+
 class StartingVerbExtractor(BaseEstimator, TransformerMixin):
 
     def starting_verb(self, text):
-        sentence_list = nltk.sent_tokenize(text)
-        for sentence in sentence_list:
-            pos_tags = nltk.pos_tag(tokenize(sentence))
-            first_word, first_tag = pos_tags[0]
-            if first_tag in ['VB', 'VBP'] or first_word == 'RT':
-                return True
-        return False
+        return starting_verb(text)
 
     def fit(self, x, y=None):
         return self
 
     def transform(self, X):
-        X_tagged = pd.Series(X).apply(self.starting_verb)
-        return pd.DataFrame(X_tagged)
+        X_tagged = pd.Series(X).map(self.starting_verb).to_numpy(dtype=np.uint8)
+        return sparse.csr_matrix(X_tagged.reshape(-1, 1))
     
     
 def load_data(database_filepath):
@@ -58,12 +95,17 @@ def load_data(database_filepath):
     """
     
     engine = create_engine("sqlite:///" + database_filepath)
-    df = pd.read_sql_table('messages', engine)
-    X = df['message'].values
-    Y = df.iloc[:, 4:].values
-    category_names = df.iloc[:, 4:].columns
+    # stream the table in chunks and keep only the messages and labels,
+    # so the full frame (with the original text) is never held at once
+    X, Y = [], []
+    for chunk in pd.read_sql_table('messages', engine, chunksize=5000):
+        X.extend(chunk['message'])
+        Y.append(chunk.iloc[:, 4:].to_numpy(dtype=np.uint8))
+    if not X:
+        raise ValueError('The messages table in {} is empty'.format(database_filepath))
+    category_names = chunk.iloc[:, 4:].columns
     
-    return X, Y, category_names
+    return np.array(X, dtype=object), np.vstack(Y), category_names
 
 def tokenize(text):
     """
@@ -76,55 +118,95 @@ def tokenize(text):
     Returns:
     clean_tokens    A list of tokenized, lemmatized and cleaned text
     """
-        
-    url_regex = 'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    detected_urls = re.findall(url_regex, text)
-    for url in detected_urls:
-        text = text.replace(url, "urlplaceholder")
 
-    tokens = word_tokenize(text)
-    lemmatizer = WordNetLemmatizer()
+    # hand out a fresh list so callers can't mutate the cached tokens
+    return list(_analyze(text)[0])
+
+
+@lru_cache(maxsize=50000)
+def _analyze(text):
+    # the vectorizer and the starting verb check both need the tokens of the
+    # same message: tokenize each sentence once, tag it for the starting verb
+    # check and cache both results. The feature union runs the vectorizer over
+    # the whole corpus before the starting verb check, so the cache has to hold
+    # the corpus (~26k messages); after training it only serves repeated
+    # predictions on the same text
+    text = _URL_RE.sub("urlplaceholder", text)
+
+    tokens = []
+    starts_with_verb = False
+    for sentence in nltk.sent_tokenize(text):
+        sentence_tokens = [_clean_token(tok) for tok in word_tokenize(sentence, preserve_line=True)]
+        if sentence_tokens and not starts_with_verb:
+            first_word, first_tag = _TAGGER.tag(sentence_tokens)[0]
+            starts_with_verb = first_tag in ['VB', 'VBP'] or first_word == 'RT'
+        tokens.extend(sentence_tokens)
 
-    clean_tokens = []
-    for tok in tokens:
-        clean_tok = lemmatizer.lemmatize(tok).lower().strip()
-        clean_tokens.append(clean_tok)
+    return tuple(tokens), starts_with_verb
 
-    return clean_tokens
+
+@lru_cache(maxsize=None)
+def _clean_token(tok):
+    # the vocabulary is small compared to the number of tokens, so each
+    # distinct token only goes through WordNet once
+    return _LEMMATIZER.lemmatize(tok).lower().strip()
+
+
+def build_features():
+    """
+    build_features
+    Turn the messages into features: hashed token counts and the starting verb flag
+    Both steps are stateless, so the features can be computed once before the data is split
+    
+    Returns:
+    features      feature union transforming a list of messages into a sparse matrix
+    """
+    
+    features = FeatureUnion([
+        ('vect', HashingVectorizer(tokenizer=tokenize, n_features=_N_FEATURES,
+                                   alternate_sign=False, norm=None,
+                                   dtype=np.float32)),
+        ('starting_verb', StartingVerbExtractor())
+    ])
+    
+    return features
 
 
 def build_model():
     """
     build_model
-    Process cleaned text and model pipeline
-    Define parameters for GridSearchCV
+    Model pipeline on top of the features from build_features
+    Define parameter distributions for RandomizedSearchCV
     
     Returns:
-    cv      gridsearch object as final model pipeline
+    cv      randomized search object as final model pipeline
     """
     
     pipeline = Pipeline([
-        ('features', FeatureUnion([
+        # weight only the hashed counts, the starting verb flag (the last
+        # column) is passed through as is
+        ('tfidf', ColumnTransformer([
+            ('text', TfidfTransformer(), slice(0, _N_FEATURES))
+        ], remainder='passthrough')),
 
-            ('text_pipeline', Pipeline([
-                ('vect', CountVectorizer(tokenizer=tokenize)),
-                ('tfidf', TfidfTransformer())
-            ])),
-
-            ('starting_verb', StartingVerbExtractor())
-        ])),
+        # most hashed columns are empty, they only slow the forests down
+        ('drop_empty', VarianceThreshold()),
 
+        # one forest per category
         ('clf', MultiOutputClassifier(RandomForestClassifier()))
     ])
     
     
     parameters = {
-            'features__text_pipeline__vect__ngram_range': ((1, 1), (1, 2)),
-            'clf__estimator__n_estimators': [20, 50, 100],
-            'clf__estimator__min_samples_split': [2,5,10]
+            'clf__estimator__n_estimators': randint(20, 150),
+            'clf__estimator__min_samples_split': randint(2, 15)
         }
 
-    cv = GridSearchCV(pipeline, param_grid=parameters)
+    # sample a few candidates instead of fitting the full grid; the search is
+    # the only parallel level, the forests stay single-threaded to avoid
+    # nesting joblib pools inside the search workers (and in the saved model)
+    cv = RandomizedSearchCV(pipeline, param_distributions=parameters, n_iter=8,
+                            n_jobs=-1, cv=3, random_state=0)
     
     return cv
 
@@ -132,30 +214,26 @@ def build_model():
 def evaluate_model(model, X_test, Y_test, category_names):
     """
     evaluate_model
-    Evaluate the models with different parameters and determine the best one 
+    Pick the best model found by the search and evaluate it on the test data
     
     Input:
-    model               the final model built
-    X_test              dataframe contains test data for explantory variables
+    model               the final model built, already fitted on the training data
+    X_test              sparse feature matrix of the test data
     Y_test              dataframe contains test data for the response variable
     category_names      list of category names 
     
     Returns:
     best_model      the final model that fits the data best
     """
-    result = model.fit(X_test, Y_test)
-    best_model = result.best_estimator_
+    best_model = model.best_estimator_
     Y_pred = best_model.predict(X_test)
-    
-    y_test=pd.DataFrame(Y_test)
-    y_pred=pd.DataFrame(Y_pred)
-    y_test.columns = category_names
-    y_pred.columns = category_names
 
-    for column in category_names:
-        print(classification_report(y_test[column], y_pred[column]))
-        accuracy = (y_test[column] == y_pred[column]).mean()
-        print("Accuracy:", accuracy)
+    # report all categories at once on the label matrices
+    print(classification_report(Y_test, Y_pred, target_names=list(category_names),
+                                zero_division=0))
+    accuracy = pd.Series((Y_test == Y_pred).mean(axis=0), index=category_names)
+    print("Accuracy:")
+    print(accuracy)
         
     return best_model
 
@@ -169,7 +247,9 @@ def save_model(model, model_filepath):
     model_filepath      filepath to save the model
     """
     
-    pickle.dump(model, open(model_filepath, 'wb'))
+    # joblib stores the numpy arrays of the trees efficiently; compression
+    # shrinks the file a lot for a small cost in save and load time
+    joblib.dump(model, model_filepath, compress=3, protocol=pickle.HIGHEST_PROTOCOL)
     
     
 def main():
@@ -177,6 +257,15 @@ def main():
         database_filepath, model_filepath = sys.argv[1:]
         print('Loading data...\n    DATABASE: {}'.format(database_filepath))
         X, Y, category_names = load_data(database_filepath)
+
+        print('Extracting features...')
+        # the features are stateless, so every message is tokenized only once
+        # and the split happens on the sparse matrix
+        features = build_features()
+        X = features.fit_transform(X)
+        # every message has been tokenized now, don't keep them all in memory
+        # during the search
+        _analyze.cache_clear()
         X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=0.2)
         
         print('Building model...')
@@ -188,6 +277,9 @@ def main():
         print('Evaluating model...')
         best_model=evaluate_model(model, X_test, Y_test, category_names)
 
+        # save the features together with the model so it classifies raw messages
+        best_model = Pipeline([('features', features), ('model', best_model)])
+
         print('Saving model...\n    MODEL: {}'.format(model_filepath))
         save_model(best_model, model_filepath)
 